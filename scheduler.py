@@ -24,18 +24,37 @@ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
+import collections
 import datetime
+import enum
 import functools
+import heapq
+import itertools
 import logging
+import os
 import time
 import threading
 
 logger = logging.getLogger('schedule')
 
+Unit = enum.IntEnum('Unit', 'SECONDS MINUTES HOURS DAYS WEEKS')
+
+# Length of each `Unit` in seconds, indexed by `unit - 1`
+_UNIT_SECONDS = (1, 60, 3600, 86400, 7 * 86400)
+
 
 class Scheduler:
     def __init__(self):
-        self.jobs = []
+        self._jobs = []  # heap of jobs ordered by next run
+        # Jobs scheduled since the last tick, possibly from other threads.
+        # Only the thread running run_pending moves them onto the heap.
+        self._pending_adds = collections.deque()
+        self._next_deadline_ts = None  # cached _next_run_ts of the heap root
+        # Guards the heap, staged jobs and cached deadline, which other
+        # threads reach through do() and clear(); never held while a job
+        # runs.
+        self._lock = threading.Lock()
+        self._clear_count = 0  # bumped by clear() to abandon running ticks
 
     def run_pending(self):
         """Run all jobs that are scheduled to run.
@@ -46,13 +65,35 @@ class Scheduler:
         increments then your job won't be run 60 times in between but
         only once.
         """
-        runnable_jobs = (job for job in self.jobs if job.should_run)
-        for job in sorted(runnable_jobs):
-            job.run()
+        now = time.time()
+        # Nothing staged and the soonest job is not due: skip the heap
+        if not self._pending_adds and (self._next_deadline_ts is None or
+                                       self._next_deadline_ts > now):
+            return
+        with self._lock:
+            self._drain_pending_adds()
+            clear_count = self._clear_count
+            # Pop every due job before running any, so a job rescheduled
+            # at or before `now` still runs only once per tick
+            due_jobs = []
+            while self._jobs and self._jobs[0]._next_run_ts <= now:
+                due_jobs.append(heapq.heappop(self._jobs))
+        for job in due_jobs:
+            if clear_count != self._clear_count:
+                break
+            job.run(now)
+        with self._lock:
+            # Jobs cleared during the tick must not be scheduled again
+            if clear_count == self._clear_count:
+                for job in due_jobs:
+                    heapq.heappush(self._jobs, job)
+            self._next_deadline_ts = (self._jobs[0]._next_run_ts
+                                      if self._jobs else None)
 
     def run_continuously(self, interval=10):
         """Continuously run, while executing pending jobs at each elapsed
-        time interval.
+        time interval. The thread wakes up early when the next job is due
+        before the interval elapses, or as soon as the run is ceased.
 
         @return cease_continuous_run: threading.Event which can be set to
         cease continuous run.
@@ -64,66 +105,191 @@ class Scheduler:
         only once.
         """
         cease_continuous_run = threading.Event()
-
-        class ScheduleThread(threading.Thread):
-            @classmethod
-            def run(cls):
-                while not cease_continuous_run.is_set():
-                    self.run_pending()
-                    time.sleep(interval)
-
-        continuous_thread = ScheduleThread()
-        continuous_thread.start()
+        _ScheduleThread(self, interval, cease_continuous_run).start()
         return cease_continuous_run
 
+    def _sleep_budget(self, interval):
+        """Seconds to wait before the next tick: until the next job is
+        due, but no longer than `interval`."""
+        idle = self.idle_seconds
+        if idle is None:
+            return interval
+        return max(0, min(interval, idle))
+
     def run_all(self, delay_seconds=0):
         """Run all jobs regardless if they are scheduled to run or not.
 
         A delay of `delay` seconds is added between each job. This helps
         distribute system load generated by the jobs more evenly
         over time."""
-        logger.info('Running *all* %i jobs with %is delay inbetween',
-                    len(self.jobs), delay_seconds)
-        for job in self.jobs:
+        with self._lock:
+            self._drain_pending_adds()
+            jobs = list(self._jobs)
+            clear_count = self._clear_count
+        if logger.isEnabledFor(logging.INFO):
+            logger.info('Running *all* %i jobs with %is delay inbetween',
+                        len(jobs), delay_seconds)
+        for job in jobs:
             job.run()
             time.sleep(delay_seconds)
+        with self._lock:
+            if clear_count == self._clear_count:
+                # every job was rescheduled, so the heap order no longer holds
+                heapq.heapify(self._jobs)
+                if self._jobs:
+                    self._next_deadline_ts = self._jobs[0]._next_run_ts
+
+    def clear(self):
+        """Deletes all scheduled jobs."""
+        with self._lock:
+            self._jobs.clear()
+            self._pending_adds.clear()
+            self._next_deadline_ts = None
+            self._clear_count += 1
+
+    def every(self, interval=1):
+        """Schedule a new periodic job.
+
+        The job is added to the scheduler once `Job.do` is called, as it
+        has no next run time before that."""
+        return Job(interval, self)
+
+    def _add_job(self, job):
+        """Stage a fully configured job to be moved onto the job heap."""
+        with self._lock:
+            self._pending_adds.append(job)
+            if (self._next_deadline_ts is None or
+                    job._next_run_ts < self._next_deadline_ts):
+                self._next_deadline_ts = job._next_run_ts
+
+    def _drain_pending_adds(self):
+        """Move staged jobs onto the job heap. Must hold `_lock`."""
+        while self._pending_adds:
+            heapq.heappush(self._jobs, self._pending_adds.popleft())
+
+    @property
+    def jobs(self):
+        """List of all scheduled jobs, including staged ones."""
+        with self._lock:
+            return self._jobs + list(self._pending_adds)
+
+    @property
+    def next_run(self):
+        """Datetime when the next job should run, or None without jobs."""
+        if self._next_deadline_ts is None:
+            return None
+        return datetime.datetime.fromtimestamp(self._next_deadline_ts)
+
+    @property
+    def idle_seconds(self):
+        """Number of seconds until `next_run`, or None without jobs."""
+        if self._next_deadline_ts is None:
+            return None
+        return self._next_deadline_ts - time.time()
+
+
+class _ScheduleThread(threading.Thread):
+    """Thread behind `Scheduler.run_continuously`, which ticks `sched`
+    until `stop_event` is set."""
+    def __init__(self, sched, interval, stop_event):
+        super().__init__()
+        self._sched = sched
+        self._interval = interval
+        self._stop_event = stop_event
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self._sched.run_pending()
+            self._stop_event.wait(self._sched._sleep_budget(self._interval))
+
+
+class ShardedScheduler:
+    """Spreads jobs round-robin over several `Scheduler` shards, each
+    with its own job heap and, when run continuously, its own thread.
+
+    Meant for setups with thousands of jobs; a single `Scheduler` is
+    cheaper otherwise."""
+    def __init__(self, shards=None):
+        if shards is None:
+            shards = os.cpu_count() or 1
+        assert shards >= 1
+        self._shards = [Scheduler() for _ in range(shards)]
+        self._next_shard = itertools.cycle(self._shards)
+
+    @property
+    def jobs(self):
+        """List of the jobs of every shard."""
+        return [job for shard in self._shards for job in shard.jobs]
+
+    def run_pending(self):
+        """Run all jobs that are scheduled to run, shard by shard."""
+        for shard in self._shards:
+            shard.run_pending()
+
+    def run_continuously(self, interval=10):
+        """Continuously run every shard in its own thread.
+
+        @return cease_continuous_run: threading.Event which can be set to
+        cease continuous run of all shards.
+        """
+        cease_continuous_run = threading.Event()
+        for shard in self._shards:
+            _ScheduleThread(shard, interval, cease_continuous_run).start()
+        return cease_continuous_run
+
+    def run_all(self, delay_seconds=0):
+        """Run all jobs of every shard regardless if they are scheduled
+        to run or not."""
+        for shard in self._shards:
+            shard.run_all(delay_seconds)
 
     def clear(self):
         """Deletes all scheduled jobs."""
-        del self.jobs[:]
+        for shard in self._shards:
+            shard.clear()
 
     def every(self, interval=1):
-        """Schedule a new periodic job."""
-        job = Job(interval)
-        self.jobs.append(job)
-        return job
+        """Schedule a new periodic job on the next shard in turn."""
+        return next(self._next_shard).every(interval)
 
     @property
     def next_run(self):
-        """Datetime when the next job should run."""
-        return min(self.jobs).next_run
+        """Datetime when the next job should run, or None without jobs."""
+        next_runs = (shard.next_run for shard in self._shards)
+        return min((t for t in next_runs if t is not None), default=None)
 
     @property
     def idle_seconds(self):
-        """Number of seconds until `next_run`."""
-        return (self.next_run - datetime.datetime.now()).total_seconds()
+        """Number of seconds until `next_run`, or None without jobs."""
+        idle = (shard.idle_seconds for shard in self._shards)
+        return min((t for t in idle if t is not None), default=None)
 
 
 class Job:
     """A periodic job as used by `Scheduler`."""
-    def __init__(self, interval):
+    _seq_counter = itertools.count()
+
+    def __init__(self, interval, scheduler=None):
         self.interval = interval  # pause interval * unit between runs
         self.job_func = None  # the job job_func to run
-        self.unit = None  # time units, e.g. 'minutes', 'hours', ...
+        self._func_name = None  # name of the function passed to do()
+        self._func_args = ()  # positional arguments bound in do()
+        self._func_kwargs = {}  # keyword arguments bound in do()
+        self.unit = None  # time units, e.g. Unit.MINUTES, Unit.HOURS, ...
         self.at_time = None  # optional time at which this job runs
-        self.last_run = None  # datetime of the last run
-        self.next_run = None  # datetime of the next run
+        self._last_run_ts = None  # time.time() of the last run
+        self._next_run_ts = None  # time.time() of the next run
         self.period = None  # timedelta between runs, only valid for
+        self._period_seconds = None  # period as float seconds
+        self.scheduler = scheduler  # scheduler to register with in do()
+        self._repr_prefix = None  # cached start of __repr__, set in do()
+        self._seq = next(Job._seq_counter)  # tie-breaker for equal next_run
 
     def __lt__(self, other):
         """PeriodicJobs are sortable based on the scheduled time
-        they run next."""
-        return self.next_run < other.next_run
+        they run next, falling back to creation order on ties."""
+        return (self._next_run_ts, self._seq) < (other._next_run_ts,
+                                                 other._seq)
 
     def __repr__(self):
         def format_time(t):
@@ -132,22 +298,26 @@ class Job:
         timestats = '(last run: %s, next run: %s)' % (
                     format_time(self.last_run), format_time(self.next_run))
 
-        job_func_name = self.job_func.__name__
-        args = [repr(x) for x in self.job_func.args]
+        return self._repr_prefix + ' ' + timestats
+
+    def _build_repr_prefix(self):
+        """Format the part of __repr__ that does not change between runs."""
+        unit = self.unit.name.lower()
+        args = [repr(x) for x in self._func_args]
         kwargs = ['%s=%s' % (k, repr(v))
-                  for k, v in self.job_func.keywords.items()]
-        call_repr = job_func_name + '(' + ', '.join(args + kwargs) + ')'
+                  for k, v in self._func_kwargs.items()]
+        call_repr = self._func_name + '(' + ', '.join(args + kwargs) + ')'
 
         if self.at_time is not None:
-            return 'Every %s %s at %s do %s %s' % (
+            return 'Every %s %s at %s do %s' % (
                    self.interval,
-                   self.unit[:-1] if self.interval == 1 else self.unit,
-                   self.at_time, call_repr, timestats)
+                   unit[:-1] if self.interval == 1 else unit,
+                   self.at_time, call_repr)
         else:
-            return 'Every %s %s do %s %s' % (
+            return 'Every %s %s do %s' % (
                    self.interval,
-                   self.unit[:-1] if self.interval == 1 else self.unit,
-                   call_repr, timestats)
+                   unit[:-1] if self.interval == 1 else unit,
+                   call_repr)
 
     @property
     def second(self):
@@ -156,7 +326,7 @@ class Job:
 
     @property
     def seconds(self):
-        self.unit = 'seconds'
+        self.unit = Unit.SECONDS
         return self
 
     @property
@@ -166,7 +336,7 @@ class Job:
 
     @property
     def minutes(self):
-        self.unit = 'minutes'
+        self.unit = Unit.MINUTES
         return self
 
     @property
@@ -176,7 +346,7 @@ class Job:
 
     @property
     def hours(self):
-        self.unit = 'hours'
+        self.unit = Unit.HOURS
         return self
 
     @property
@@ -186,7 +356,7 @@ class Job:
 
     @property
     def days(self):
-        self.unit = 'days'
+        self.unit = Unit.DAYS
         return self
 
     @property
@@ -196,7 +366,7 @@ class Job:
 
     @property
     def weeks(self):
-        self.unit = 'weeks'
+        self.unit = Unit.WEEKS
         return self
 
     def at(self, time_str):
@@ -205,7 +375,7 @@ class Job:
         Calling this is only valid for jobs scheduled to run every
         N day(s).
         """
-        assert self.unit == 'days'
+        assert self.unit is Unit.DAYS
         hour, minute = [int(t) for t in time_str.split(':')]
         assert 0 <= hour <= 23
         assert 0 <= minute <= 59
@@ -219,37 +389,79 @@ class Job:
         Any additional arguments are passed on to job_func when
         the job runs.
         """
-        self.job_func = functools.partial(job_func, *args, **kwargs)
-        functools.update_wrapper(self.job_func, job_func)
+        if self.interval <= 0:
+            raise ValueError('interval must be positive, got %r'
+                             % self.interval)
+        if args or kwargs:
+            self.job_func = functools.partial(job_func, *args, **kwargs)
+            functools.update_wrapper(self.job_func, job_func)
+        else:
+            # Nothing to bind, so skip the extra call frame of a partial
+            self.job_func = job_func
+        # Callables like partials have no __name__, which only logging needs
+        self._func_name = getattr(job_func, '__name__', repr(job_func))
+        self._func_args = args
+        self._func_kwargs = kwargs
+        assert self.unit is not None
+        self._period_seconds = self.interval * _UNIT_SECONDS[self.unit - 1]
+        self.period = datetime.timedelta(seconds=self._period_seconds)
+        self._repr_prefix = self._build_repr_prefix()
         self._schedule_next_run()
+        if self.scheduler is not None:
+            self.scheduler._add_job(self)
         return self
 
+    @property
+    def last_run(self):
+        """Datetime of the last run, or None if the job never ran."""
+        if self._last_run_ts is None:
+            return None
+        return datetime.datetime.fromtimestamp(self._last_run_ts)
+
+    @property
+    def next_run(self):
+        """Datetime of the next run, or None if the job is not scheduled."""
+        if self._next_run_ts is None:
+            return None
+        return datetime.datetime.fromtimestamp(self._next_run_ts)
+
     @property
     def should_run(self):
         """True if the job should be run now."""
-        return datetime.datetime.now() >= self.next_run
-
-    def run(self):
-        """Run the job and immediately reschedule it."""
-        logger.info('Running job %s', self)
+        return time.time() >= self._next_run_ts
+
+    def run(self, now=None):
+        """Run the job and immediately reschedule it.
+
+        `now` is a `time.time()` timestamp which lets the caller share
+        a single clock read between all jobs run in the same tick."""
+        if now is None:
+            now = time.time()
+        # Skip the logging call entirely when INFO records are discarded
+        if logger.isEnabledFor(logging.INFO):
+            logger.info('Running job %s', self)
         # Modified from original code to thread each job call
         threading.Thread(target=self.job_func).start()
-        self.last_run = datetime.datetime.now()
-        self._schedule_next_run()
+        self._last_run_ts = now
+        self._schedule_next_run(now)
 
-    def _schedule_next_run(self):
+    def _schedule_next_run(self, now=None):
         """Compute the instant when this job should run next."""
-        assert self.unit in ('seconds', 'minutes', 'hours', 'days', 'weeks')
-        self.period = datetime.timedelta(**{self.unit: self.interval})
-        self.next_run = datetime.datetime.now() + self.period
-        if self.at_time:
-            assert self.unit == 'days'
-            self.next_run = self.next_run.replace(hour=self.at_time.hour,
-                                                  minute=self.at_time.minute,
-                                                  second=self.at_time.second,
-                                                  microsecond=0)
+        if now is None:
+            now = time.time()
+        self._next_run_ts = now + self._period_seconds
+        if self.at_time is not None:
+            assert self.unit is Unit.DAYS
+            # Done on local datetimes, which only happens about once a day,
+            # so the OS resolves DST: a time skipped by the clocks jumping
+            # forward runs just after the jump, a repeated one runs the
+            # first time it occurs
+            local_now = datetime.datetime.fromtimestamp(now)
+            days = self.interval
             # If we are running for the first time, make sure we run
             # at the specified time *today* as well
-            if (not self.last_run and
-                    self.at_time > datetime.datetime.now().time()):
-                self.next_run = self.next_run - datetime.timedelta(days=1)
+            if self._last_run_ts is None and self.at_time > local_now.time():
+                days -= 1
+            next_day = local_now.date() + datetime.timedelta(days=days)
+            self._next_run_ts = datetime.datetime.combine(
+                next_day, self.at_time).timestamp()